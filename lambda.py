@@ -1,110 +1,206 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import tarfile
-import os
-import shutil
-from datetime import datetime
-import pathlib
+import io
+import time
+from datetime import date, datetime, timedelta
+from enum import Enum
+from typing import Optional
+from pathlib import PurePosixPath
+from urllib.parse import unquote_plus
 import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import yaml
+
+    # The libyaml C parser, when PyYAML was built with it
+    YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+except ImportError:
+    yaml = None
+
+# How many files are uploaded to S3 at the same time
+UPLOAD_WORKERS = 32
+
+# How many notes can wait in memory to be uploaded
+MAX_PENDING_UPLOADS = UPLOAD_WORKERS * 2
+
+# Made once and reused by warm invocations. Boto3 clients are thread-safe,
+# and the connection pool is as big as the upload pool, otherwise the
+# uploads would wait on the default pool of 10 connections
+S3 = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=UPLOAD_WORKERS,
+        retries={"mode": "adaptive"},
+    ),
+)
+
+# Notes are a few KB each, so every upload is a single PUT made on the
+# calling thread. The parallelism comes from the upload pool instead of
+# a transfer manager starting threads for every small file
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    max_concurrency=1,
+    use_threads=False,
+)
+
+# The 'date:' line inside the metadata at the top of a note
+METADATA_DATE = re.compile(r"^date:[ \t]*(\S+)", re.MULTILINE)
+
+# File dates before 1991 are not real, like the 1970 ones
+MIN_VALID_TIMESTAMP = datetime(1991, 1, 1).timestamp()
+
+
+class NoteKind(Enum):
+    """
+    Which kind of Periodic note a note is, based on the folder it is in.
+    """
+
+    NONE = 0
+    DAILY = 1
+    WEEKLY = 2
+    MONTHLY = 3
+    YEARLY = 4
 
 
-def decompress(archive_name: str, extract_dir: str) -> None:
-    with tarfile.open(archive_name, "r:gz") as tar:
-        tar.extractall(extract_dir)
-    return
+# Folders under /Periodic/ and the kind of note inside them
+PERIODIC_FOLDERS = {
+    "Daily Notes": NoteKind.DAILY,
+    "Weekly Notes": NoteKind.WEEKLY,
+    "Monthly Notes": NoteKind.MONTHLY,
+    "Yearly Notes": NoteKind.YEARLY,
+}
 
 
-def get_note_creation_date(note_file: str) -> str:
+def first_day_of_week(year: int, week: int) -> date:
+    """
+    Same as datetime.strptime(f"{year}-W{week}-1", "%Y-W%W-%w"), without
+    parsing a string. Week 1 starts on the first Monday of the year.
+    """
+    jan1 = date(year, 1, 1)
+    first_monday = jan1 + timedelta(days=(7 - jan1.weekday()) % 7)
+    # There is no week 0 when the year starts on a Monday
+    if week == 0 and first_monday == jan1:
+        return jan1
+    return first_monday + timedelta(weeks=week - 1)
+
+
+def get_metadata_date(header: str) -> Optional[str]:
+    """
+    Gets the date from the metadata at the top of a note. When PyYAML is
+    installed the metadata is parsed as YAML, which also understands quoted
+    dates and dates with a time. Without it, or if the metadata is not valid
+    YAML, falls back to looking for the 'date:' line.
+    """
+    if yaml is not None:
+        try:
+            metadata = yaml.load(header, Loader=YAML_LOADER)
+        except (yaml.YAMLError, ValueError):
+            # ValueError is for dates that don't exist, like 2023-02-30,
+            # which the regex below still returns as they are written
+            metadata = None
+
+        if isinstance(metadata, dict):
+            value = metadata.get("date")
+            # Both dates and datetimes
+            if isinstance(value, date):
+                return value.strftime("%Y-%m-%d")
+            # Lists, maps and empty values are not a date
+            if not isinstance(value, (str, int, float)) or not str(value).strip():
+                return None
+            return str(value).split()[0]
+
+    match = METADATA_DATE.search(header)
+    return match.group(1) if match else None
+
+
+def get_note_creation_date(
+    note: PurePosixPath, content: str, mtime: float, kind: NoteKind
+) -> str:
     """
     Rule here is a bit more complicated than just getting the ctime.
-    1. Open the note, if it has metadata, which is defined by a '---' at the top
+    1. Look at the note content, if it has metadata, which is defined by a '---' at the top
     of the file, then use the date from the metadata.
     2. If it doesn't have metadata then I check if the date is Periodic,
     if it is, I will get the date from the name of the file, having logic
     for both daily, weekly and monthly note.
-    3. Finally, I get the oldest from the ctime, mtime, atime and birth,
+    3. Finally, I get the mtime, which is the only date kept in the archive,
     watching out to not get dates in 1970.
     """
-    with open(note_file, "r") as f:
-        content = f.read()
-
     if content.startswith("---"):
-        # Get the date from the metadata
-        lines = content.split("\n")
-        for line in lines:
-            if line.startswith("date:"):
-                return line.split(" ")[1]
-
-    # Check if /Periodic/ is in the path
-    if "/Periodic/" in note_file:
-        # Get the basename of the file
-        fname = os.path.basename(note_file)
-
-        # If /Daily Notes/ is in the path then
+        # Get the date from the metadata, only looking
+        # until the '---' that closes it
+        header_end = content.find("\n---", 3)
+        header = content[3:header_end] if header_end != -1 else content[3:]
+        metadata_date = get_metadata_date(header)
+        if metadata_date:
+            return metadata_date
+
+    # The kind tells if the note is inside /Periodic/ and in which folder
+    if kind != NoteKind.NONE:
+        # Get the name of the file
+        fname = note.name
+
+        # If in /Daily Notes/ then
         # the file is like this: 2021-07-23 (Friday).md
         # so just split by space and get the first part
-        if "/Daily Notes/" in note_file:
+        if kind == NoteKind.DAILY:
             return fname.split(" ")[0]
 
-        # If /Weekly Notes/ is in the path then
+        # If in /Weekly Notes/ then
         # its like 2023-W29.md. So get this part
         # transform this into the first day of the week
         # and return it
-        if "/Weekly Notes/" in note_file:
+        if kind == NoteKind.WEEKLY:
             year, week = fname.removesuffix(".md").split("-W")
-            week = int(week)
-            d = datetime.strptime(f"{year}-W{week}-1", "%Y-W%W-%w")
+            d = first_day_of_week(int(year), int(week))
             return d.strftime("%Y-%m-%d")
 
-        # If /Monthly Notes/ is in the path then
+        # If in /Monthly Notes/ then
         # its 2023-07.md. So just add -01 to the end
         # and return it
-        if "/Monthly Notes/" in note_file:
+        if kind == NoteKind.MONTHLY:
             return fname.removesuffix(".md") + "-01"
 
-        # If /Yearly Notes/ is in the path then
+        # If in /Yearly Notes/ then
         # its 2023.md. So just add -01-01 to the end
         # and return it
-        if "/Yearly Notes/" in note_file:
+        if kind == NoteKind.YEARLY:
             return fname.removesuffix(".md") + "-01-01"
 
-    # Finally then get the stats of the file
-    # and return the oldest date
-    stats = os.stat(note_file)
-
-    # birthtime can fail
-    try:
-        birthtime = (datetime.fromtimestamp(stats.st_birthtime),)
-    except Exception as e:
-        birthtime = datetime.fromtimestamp(1)
-
-    dates = [
-        datetime.fromtimestamp(stats.st_ctime),
-        datetime.fromtimestamp(stats.st_mtime),
-        datetime.fromtimestamp(stats.st_atime),
-        birthtime,
-    ]
-    # Remove all older than 1990 to make sure
-    dates = [d for d in dates if d.year > 1990]
-    return min(dates).strftime("%Y-%m-%d")
-
-
-def note_to_json(note_file: str) -> dict:
-    stats = os.stat(note_file)
-    # Path is everything except the final file and the vault
-    path = "/".join(note_file.split("/")[1:-1])
-    # Folder is the last folder in the path
-    folder = path.split("/")[-1]
+    # Finally then use the mtime. If it is older than 1991 it is not real,
+    # so use the current time, as the ctime of an extracted file would be
+    created = mtime if mtime >= MIN_VALID_TIMESTAMP else time.time()
+    return datetime.fromtimestamp(created).strftime("%Y-%m-%d")
 
-    with open(note_file, "r") as f:
-        content = f.read()
+
+def note_to_json(
+    note: PurePosixPath, content: str, mtime: float, kind: NoteKind
+) -> dict:
+    """
+    note is the path of the note inside the vault.
+    """
+    # Path is every folder of the note
+    path = "/".join(note.parent.parts)
+    # Folder is the last folder in the path
+    folder = note.parent.name
+    # modified_date is the date part of modified_time
+    modified_time = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S")
 
     data = {
-        "title": os.path.basename(note_file).removesuffix(".md"),
-        "created_date": get_note_creation_date(note_file),
-        "modified_date": datetime.fromtimestamp(stats.st_mtime).strftime("%Y-%m-%d"),
-        "modified_time": datetime.fromtimestamp(stats.st_mtime).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        ),
+        "title": note.stem,
+        "created_date": get_note_creation_date(note, content, mtime, kind),
+        "modified_date": modified_time[:10],
+        "modified_time": modified_time,
         "path": path,
         "folder": folder,
         "content": content,
@@ -113,98 +209,192 @@ def note_to_json(note_file: str) -> dict:
     return data
 
 
-def upload_directory_to_s3(local_dir, bucket_name):
-    s3 = boto3.client("s3")
+def to_json_bytes(data: dict) -> bytes:
+    """
+    Serializes data with orjson when it is installed,
+    since it is a lot faster on the long note contents.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def is_hidden(name: str) -> bool:
+    """
+    Directories that start with . or _ are not part of the notes.
+    """
+    return name.startswith((".", "_"))
 
-    for root, dirs, files in os.walk(local_dir):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, local_dir)
-            s3_path = os.path.join(bucket_name, relative_path).replace("\\", "/")
 
-            # Remove the leading directory name (vault) from the S3 path
-            # to upload directly to the root of the bucket
-            s3_path = "/".join(s3_path.split("/")[1:])
+def get_note_kind(folders: tuple) -> NoteKind:
+    """
+    Which kind of Periodic note is inside the folders, given from the
+    vault root down.
+    """
+    periodic = False
+    kind = NoteKind.NONE
+    for name in folders:
+        periodic = periodic or name == "Periodic"
+        if periodic and name in PERIODIC_FOLDERS:
+            kind = PERIODIC_FOLDERS[name]
+    return kind
+
+
+def iter_notes(tar: tarfile.TarFile):
+    """
+    Goes through the archive once, as a stream, and yields an
+    (s3_path, json_bytes) pair for every .md note in it. A later pair
+    with the same s3_path replaces the earlier one.
+    Only the first level folders of the vault are kept, so every note
+    below one goes straight into it. Anything inside a directory that
+    starts with . or _ is skipped.
+    """
+    # If two notes end up with the same name in the same folder, the one
+    # closest to the first level folder is kept, and the first one found if
+    # they are as deep, the same rule main.py uses. Members can come in any
+    # order, so a note can be yielded again when one with the same name but
+    # fewer folders shows up later
+    depths = {}
+
+    for member in tar:
+        if not member.isfile() or not member.name.endswith(".md"):
+            continue
+
+        note = PurePosixPath(member.name)
+        folders = note.parent.parts
+        if any(is_hidden(folder) for folder in folders):
+            continue
+
+        s3_path = note.stem + ".json"
+        if folders:
+            s3_path = folders[0] + "/" + s3_path
+        if len(folders) >= depths.get(s3_path, len(folders) + 1):
+            continue
+        depths[s3_path] = len(folders)
+
+        # Read as text like open(note, "r") does, so CRLF notes end up
+        # with the same content as in main.py. The member itself can't be
+        # wrapped, since a streamed archive can't tell if it is seekable
+        raw = io.BytesIO(tar.extractfile(member).read())
+        with io.TextIOWrapper(raw, encoding="utf-8") as f:
+            content = f.read()
+        data = note_to_json(note, content, member.mtime, get_note_kind(folders))
+        yield s3_path, to_json_bytes(data)
+
+
+def upload_note(s3_path, body, bucket_name, replaces=None):
+    # A note replacing another one with the same key is only sent once
+    # that one is uploaded, so it is the one left in the bucket
+    if replaces is not None:
+        replaces.result()
+    S3.upload_fileobj(io.BytesIO(body), bucket_name, s3_path, Config=TRANSFER_CONFIG)
+
+
+def upload_notes_to_s3(notes, bucket_name) -> set:
+    """
+    Uploads the (s3_path, json_bytes) notes as they come out of the archive
+    and returns the keys uploaded. Uploads are just waiting on the network,
+    so many of them run at the same time, sharing the one client.
+    """
+    # Only MAX_PENDING_UPLOADS notes are held at a time. When the archive
+    # is read faster than notes are uploaded, reading waits here instead
+    # of keeping every note in memory
+    pending = BoundedSemaphore(MAX_PENDING_UPLOADS)
+    # The last upload of each key
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        for s3_path, body in notes:
+            pending.acquire()
+            future = executor.submit(
+                upload_note, s3_path, body, bucket_name, futures.get(s3_path)
+            )
+            future.add_done_callback(lambda _: pending.release())
+            futures[s3_path] = future
+
+    # Raise the first upload error, if any
+    for future in futures.values():
+        future.result()
+
+    return set(futures)
+
+
+def delete_stale_keys(bucket_name, keep: set):
+    """
+    Deletes every object in the bucket whose key is not in keep, with one
+    delete_objects call for each page of up to 1000 keys, running the
+    calls at the same time. Raises if any key could not be deleted.
+    """
+    pages = S3.get_paginator("list_objects_v2").paginate(Bucket=bucket_name)
+    key_pages = (
+        [
+            {"Key": obj["Key"]}
+            for obj in page.get("Contents", [])
+            if obj["Key"] not in keep
+        ]
+        for page in pages
+    )
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        responses = list(
+            executor.map(
+                lambda keys: S3.delete_objects(
+                    Bucket=bucket_name, Delete={"Objects": keys, "Quiet": True}
+                ),
+                # Pages with nothing to delete are skipped
+                filter(None, key_pages),
+            )
+        )
+
+    # delete_objects doesn't raise when some keys fail, and with
+    # Quiet only those failed keys come back in the response
+    errors = [error for response in responses for error in response.get("Errors", [])]
+    if errors:
+        raise RuntimeError(
+            f"Could not delete {len(errors)} stale keys from {bucket_name}: "
+            + ", ".join(f"{error['Key']} ({error['Code']})" for error in errors)
+        )
+
+
+def get_latest_key(bucket_name, event) -> tuple:
+    """
+    Bucket and key of the archive to process. When the Lambda is triggered
+    by an S3 ObjectCreated event both come in the event, with no listing.
+    Otherwise it is the latest modified object in bucket_name, going
+    through every page of the listing.
+    """
+    records = (event or {}).get("Records")
+    if records:
+        s3_record = records[-1]["s3"]
+        # Keys in S3 events are URL encoded
+        return s3_record["bucket"]["name"], unquote_plus(s3_record["object"]["key"])
 
-            s3.upload_file(local_path, bucket_name, s3_path)
+    pages = S3.get_paginator("list_objects_v2").paginate(Bucket=bucket_name)
+    objects = (obj for page in pages for obj in page.get("Contents", []))
+    return bucket_name, max(objects, key=lambda obj: obj["LastModified"])["Key"]
 
 
 def lambda_handler(event, context):
     source_bucket = "source"
     destination_bucket = "dest"
 
-    s3_client = boto3.client("s3")
-
-    # List all objects in the source bucket
-    response = s3_client.list_objects_v2(Bucket=source_bucket)
-
-    # Find the latest zip file (assuming zip files have a .zip extension)
-    latest_zip_key = max(response["Contents"], key=lambda obj: obj["LastModified"])[
-        "Key"
-    ]
-
-    # Download the latest zip file to the /var/task directory
-    tmp_file = os.path.join("/tmp", latest_zip_key)
-    s3_client.download_file(source_bucket, latest_zip_key, tmp_file)
-
-    vault = "/tmp/vault"
-
-    decompress(tmp_file, vault)
-
-    # Walk through the lambda_tmp_dir and remove all files that are not .md
-    # Also remove directories that start with . or _
-    for root, dirs, files in os.walk(vault):
-        for dir in dirs:
-            if dir.startswith(".") or dir.startswith("_"):
-                shutil.rmtree(os.path.join(root, dir))
-        for file in files:
-            if not file.endswith(".md"):
-                os.remove(os.path.join(root, file))
-
-    # Walk again through lambda_tmp_dir and convert all .md files to JSON
-    # delete the .md file
-    for root, dirs, files in os.walk(vault):
-        for file in files:
-            if not file.endswith(".md"):
-                continue
-            note = os.path.join(root, file)
-            data = note_to_json(note)
-            json_file = note.removesuffix(".md") + ".json"
-            # Place it where the .md file was
-            with open(json_file, "w") as f:
-                json.dump(data, f)
-
-            os.remove(note)
-
-    # Get all directories directly under vault with the /vault in front
-    first_level = [os.path.join(vault, d) for d in os.listdir(vault)]
-
-    # Go over each folder in the first level
-    # get all their files and move them to the first level.
-    # Afterward deletes every file under each first level.
-    for folder in first_level:
-        # Get, recursively, all files under this folder
-        files = list(pathlib.Path(folder).rglob("*.*"))
-        # Move each file to the first level if its not already there
-        for file in files:
-            if file.parent != pathlib.Path(vault):
-                try:
-                    shutil.move(file, folder)
-                except Exception as e:
-                    pass
-
-        # List all directories under this folder
-        dirs = [d for d in os.listdir(folder) if os.path.isdir(os.path.join(folder, d))]
-        # Delete each directory
-        for dir in dirs:
-            shutil.rmtree(os.path.join(folder, dir))
-
-    # Delete everything from the destination bucket
-    s3_resource = boto3.resource("s3")
-    s3_resource.Bucket(destination_bucket).objects.all().delete()
-
-    # # Upload the modified contents of the lambda_tmp_dir to the destination bucket
-    upload_directory_to_s3(vault, destination_bucket)
+    # Find the latest zip file, from the event or the source bucket
+    zip_bucket, latest_zip_key = get_latest_key(source_bucket, event)
+
+    # Stream the latest zip file from S3 instead of downloading it to /tmp,
+    # so downloading, decompressing and converting all overlap
+    body = S3.get_object(Bucket=zip_bucket, Key=latest_zip_key)["Body"]
+
+    # Read the archive once, converting all .md files to JSON in memory
+    # and uploading them to the destination bucket as they are converted.
+    # Nothing is written to /tmp.
+    with tarfile.open(fileobj=body, mode="r|gz") as tar:
+        uploaded = upload_notes_to_s3(iter_notes(tar), destination_bucket)
+
+    # Only once every note is uploaded, delete the ones left from before
+    # that are not in this archive. If anything above fails, the bucket
+    # keeps the previous notes
+    delete_stale_keys(destination_bucket, uploaded)
 
     return {
         "statusCode": 200,
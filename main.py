@@ -1,21 +1,119 @@
 import tarfile
 import os
 import shutil
-import pathlib
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from enum import Enum
+from typing import Optional
+from pathlib import PurePosixPath
 import json
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import yaml
+
+    # The libyaml C parser, when PyYAML was built with it
+    YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+except ImportError:
+    yaml = None
+
+# The 'date:' line inside the metadata at the top of a note
+METADATA_DATE = re.compile(r"^date:[ \t]*(\S+)", re.MULTILINE)
+
+# File dates before 1991 are not real, like the 1970 ones
+MIN_VALID_TIMESTAMP = datetime(1991, 1, 1).timestamp()
+
+# Only some platforms, like macOS, have the birth time of a file
+HAS_BIRTHTIME = hasattr(os.stat_result, "st_birthtime")
+
+
+class NoteKind(Enum):
+    """
+    Which kind of Periodic note a note is, based on the folder it is in.
+    """
+
+    NONE = 0
+    DAILY = 1
+    WEEKLY = 2
+    MONTHLY = 3
+    YEARLY = 4
+
+
+# Folders under /Periodic/ and the kind of note inside them
+PERIODIC_FOLDERS = {
+    "Daily Notes": NoteKind.DAILY,
+    "Weekly Notes": NoteKind.WEEKLY,
+    "Monthly Notes": NoteKind.MONTHLY,
+    "Yearly Notes": NoteKind.YEARLY,
+}
 
 
 def decompress(archive_name: str, extract_dir: str) -> None:
-    with tarfile.open(archive_name, "r:gz") as tar:
-        tar.extractall(extract_dir)
+    # Read the archive as a stream, so tarfile goes through it once
+    # instead of seeking around and indexing every member first
+    with tarfile.open(archive_name, "r|gz") as tar:
+        # The "data" filter is only there on newer Pythons
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(extract_dir, filter="data")
+        else:
+            tar.extractall(extract_dir)
     return
 
 
-def get_note_creation_date(note_file: str) -> str:
+def first_day_of_week(year: int, week: int) -> date:
+    """
+    Same as datetime.strptime(f"{year}-W{week}-1", "%Y-W%W-%w"), without
+    parsing a string. Week 1 starts on the first Monday of the year.
+    """
+    jan1 = date(year, 1, 1)
+    first_monday = jan1 + timedelta(days=(7 - jan1.weekday()) % 7)
+    # There is no week 0 when the year starts on a Monday
+    if week == 0 and first_monday == jan1:
+        return jan1
+    return first_monday + timedelta(weeks=week - 1)
+
+
+def get_metadata_date(header: str) -> Optional[str]:
+    """
+    Gets the date from the metadata at the top of a note. When PyYAML is
+    installed the metadata is parsed as YAML, which also understands quoted
+    dates and dates with a time. Without it, or if the metadata is not valid
+    YAML, falls back to looking for the 'date:' line.
+    """
+    if yaml is not None:
+        try:
+            metadata = yaml.load(header, Loader=YAML_LOADER)
+        except (yaml.YAMLError, ValueError):
+            # ValueError is for dates that don't exist, like 2023-02-30,
+            # which the regex below still returns as they are written
+            metadata = None
+
+        if isinstance(metadata, dict):
+            value = metadata.get("date")
+            # Both dates and datetimes
+            if isinstance(value, date):
+                return value.strftime("%Y-%m-%d")
+            # Lists, maps and empty values are not a date
+            if not isinstance(value, (str, int, float)) or not str(value).strip():
+                return None
+            return str(value).split()[0]
+
+    match = METADATA_DATE.search(header)
+    return match.group(1) if match else None
+
+
+def get_note_creation_date(
+    note: PurePosixPath, content: str, stats: os.stat_result, kind: NoteKind
+) -> str:
     """
     Rule here is a bit more complicated than just getting the ctime.
-    1. Open the note, if it has metadata, which is defined by a '---' at the top
+    1. Look at the note content, if it has metadata, which is defined by a '---' at the top
     of the file, then use the date from the metadata.
     2. If it doesn't have metadata then I check if the date is Periodic,
     if it is, I will get the date from the name of the file, having logic
@@ -23,80 +121,79 @@ def get_note_creation_date(note_file: str) -> str:
     3. Finally, I get the oldest from the ctime, mtime, atime and birth,
     watching out to not get dates in 1970.
     """
-    with open(note_file, "r") as f:
-        content = f.read()
-
     if content.startswith("---"):
-        # Get the date from the metadata
-        lines = content.split("\n")
-        for line in lines:
-            if line.startswith("date:"):
-                return line.split(" ")[1]
-
-    # Check if /Periodic/ is in the path
-    if "/Periodic/" in note_file:
-        # Get the basename of the file
-        fname = os.path.basename(note_file)
-
-        # If /Daily Notes/ is in the path then
+        # Get the date from the metadata, only looking
+        # until the '---' that closes it
+        header_end = content.find("\n---", 3)
+        header = content[3:header_end] if header_end != -1 else content[3:]
+        metadata_date = get_metadata_date(header)
+        if metadata_date:
+            return metadata_date
+
+    # The kind tells if the note is inside /Periodic/ and in which folder
+    if kind != NoteKind.NONE:
+        # Get the name of the file
+        fname = note.name
+
+        # If in /Daily Notes/ then
         # the file is like this: 2021-07-23 (Friday).md
         # so just split by space and get the first part
-        if "/Daily Notes/" in note_file:
+        if kind == NoteKind.DAILY:
             return fname.split(" ")[0]
 
-        # If /Weekly Notes/ is in the path then
+        # If in /Weekly Notes/ then
         # its like 2023-W29.md. So get this part
         # transform this into the first day of the week
         # and return it
-        if "/Weekly Notes/" in note_file:
+        if kind == NoteKind.WEEKLY:
             year, week = fname.removesuffix(".md").split("-W")
-            week = int(week)
-            d = datetime.strptime(f"{year}-W{week}-1", "%Y-W%W-%w")
+            d = first_day_of_week(int(year), int(week))
             return d.strftime("%Y-%m-%d")
 
-        # If /Monthly Notes/ is in the path then
+        # If in /Monthly Notes/ then
         # its 2023-07.md. So just add -01 to the end
         # and return it
-        if "/Monthly Notes/" in note_file:
+        if kind == NoteKind.MONTHLY:
             return fname.removesuffix(".md") + "-01"
 
-        # If /Yearly Notes/ is in the path then
+        # If in /Yearly Notes/ then
         # its 2023.md. So just add -01-01 to the end
         # and return it
-        if "/Yearly Notes/" in note_file:
+        if kind == NoteKind.YEARLY:
             return fname.removesuffix(".md") + "-01-01"
 
-    # Finally then get the stats of the file
+    # Finally then use the stats of the file
     # and return the oldest date
-    stats = os.stat(note_file)
-    dates = [
-        datetime.fromtimestamp(stats.st_ctime),
-        datetime.fromtimestamp(stats.st_mtime),
-        datetime.fromtimestamp(stats.st_atime),
-        datetime.fromtimestamp(stats.st_birthtime),
-    ]
-    # Remove all older than 1990 to make sure
-    dates = [d for d in dates if d.year > 1990]
-    return min(dates).strftime("%Y-%m-%d")
-
-
-def note_to_json(note_file: str) -> dict:
-    stats = os.stat(note_file)
-    # Path is everything except the final file and the vault
-    path = "/".join(note_file.split("/")[1:-1])
-    # Folder is the last folder in the path
-    folder = path.split("/")[-1]
+    timestamps = (stats.st_ctime, stats.st_mtime, stats.st_atime)
+    if HAS_BIRTHTIME:
+        timestamps += (stats.st_birthtime,)
+    # Remove all older than 1990 to make sure, comparing the raw
+    # timestamps so only the oldest one becomes a datetime.
+    # If none is left, use the current time
+    oldest = min((t for t in timestamps if t >= MIN_VALID_TIMESTAMP), default=None)
+    if oldest is None:
+        oldest = time.time()
+    return datetime.fromtimestamp(oldest).strftime("%Y-%m-%d")
 
-    with open(note_file, "r") as f:
-        content = f.read()
+
+def note_to_json(
+    note: PurePosixPath, content: str, stats: os.stat_result, kind: NoteKind
+) -> dict:
+    """
+    note is the path of the note inside the vault.
+    """
+    # Path is every folder of the note
+    path = "/".join(note.parent.parts)
+    # Folder is the last folder in the path
+    folder = note.parent.name
+    # modified_date is the date part of modified_time
+    modified_time = datetime.fromtimestamp(stats.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
 
     data = {
-        "title": os.path.basename(note_file).removesuffix(".md"),
-        "created_date": get_note_creation_date(note_file),
-        "modified_date": datetime.fromtimestamp(stats.st_mtime).strftime("%Y-%m-%d"),
-        "modified_time": datetime.fromtimestamp(stats.st_mtime).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        ),
+        "title": note.stem,
+        "created_date": get_note_creation_date(note, content, stats, kind),
+        "modified_date": modified_time[:10],
+        "modified_time": modified_time,
         "path": path,
         "folder": folder,
         "content": content,
@@ -105,6 +202,104 @@ def note_to_json(note_file: str) -> dict:
     return data
 
 
+def to_json_bytes(data: dict) -> bytes:
+    """
+    Serializes data with orjson when it is installed,
+    since it is a lot faster on the long note contents.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def find_notes(
+    directory: str,
+    output_dir: str,
+    nested_dirs: list,
+    relative_dir: PurePosixPath = PurePosixPath(),
+    periodic: bool = False,
+    kind: NoteKind = NoteKind.NONE,
+):
+    """
+    Walks the directory once with os.scandir and yields a
+    (note_file, note, json_file, stats, kind) tuple for every .md note,
+    where note is its path inside the vault.
+    Only the first level folders of the vault are kept, so json_file is
+    always in the first level folder the note is under, which is output_dir.
+    Files that are not .md and directories that start with . or _
+    are removed. The files of a directory come before its subdirectories.
+    Every directory below a first level folder is added to nested_dirs,
+    deepest first, so they can be removed once their notes are converted.
+    relative_dir is the path of directory inside the vault, and periodic
+    and kind say if it is under /Periodic/ and in which of its folders,
+    so all of that is worked out once per directory instead of per note.
+    """
+    # Take the entries up front, since the loop removes
+    # files in this same directory
+    with os.scandir(directory) as it:
+        entries = list(it)
+
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name.startswith((".", "_")):
+                shutil.rmtree(entry.path)
+            else:
+                subdirs.append(entry)
+            continue
+
+        if not entry.name.endswith(".md"):
+            os.remove(entry.path)
+            continue
+
+        json_file = os.path.join(output_dir, entry.name.removesuffix(".md") + ".json")
+        yield (
+            entry.path,
+            relative_dir / entry.name,
+            json_file,
+            entry.stat(follow_symlinks=False),
+            kind,
+        )
+
+    for entry in subdirs:
+        # Directly under the vault, the folder is a first level one
+        child_output = output_dir if relative_dir.parts else entry.path
+        child_periodic = periodic or entry.name == "Periodic"
+        child_kind = kind
+        if child_periodic and entry.name in PERIODIC_FOLDERS:
+            child_kind = PERIODIC_FOLDERS[entry.name]
+
+        yield from find_notes(
+            entry.path,
+            child_output,
+            nested_dirs,
+            relative_dir / entry.name,
+            child_periodic,
+            child_kind,
+        )
+
+        if relative_dir.parts:
+            nested_dirs.append(entry.path)
+
+
+def convert_note(note: tuple) -> None:
+    """
+    Converts a note from find_notes to JSON and deletes the note.
+    Runs in a worker process.
+    """
+    note_file, relative_note, json_file, stats, kind = note
+
+    # Read the note once and share it with the helpers
+    with open(note_file, "r") as f:
+        content = f.read()
+
+    data = note_to_json(relative_note, content, stats, kind)
+    with open(json_file, "wb") as f:
+        f.write(to_json_bytes(data))
+
+    os.remove(note_file)
+
+
 def main():
     compressed_file = "2023-07-23_15-00-00.tar.gz"
     vault = "vault"
@@ -112,58 +307,34 @@ def main():
     shutil.rmtree(vault, ignore_errors=True)
     decompress(compressed_file, vault)
 
-    # Walk through vault and remove all files that are not .md
-    # Also remove directories that start with . or _
-    for root, first_level, files in os.walk(vault):
-        for dir in first_level:
-            if dir.startswith(".") or dir.startswith("_"):
-                shutil.rmtree(os.path.join(root, dir))
-        for file in files:
-            if not file.endswith(".md"):
-                os.remove(os.path.join(root, file))
-
-    # Walk again through vault and convert all .md files to JSON
-    # delete the .md file
-    for root, first_level, files in os.walk(vault):
-        for file in files:
-            if not file.endswith(".md"):
-                continue
-            note = os.path.join(root, file)
-            data = note_to_json(note)
-            json_file = note.removesuffix(".md") + ".json"
-            # Place it where the .md file was
-            with open(json_file, "w") as f:
-                json.dump(data, f)
-
-            os.remove(note)
-
-    # Now I will only keep the highest level folders
-    # inside the 'vault.
-    # All files below this first level will be moved
-    # to their parent folder and the folder will be deleted
-
-    # Get all directories directly under vault with the /vault in front
-    first_level = [os.path.join(vault, d) for d in os.listdir(vault)]
-
-    # Go over each folder in the first level
-    # get all their files and move them to the first level.
-    # Afterward deletes every file under each first level.
-    for folder in first_level:
-        # Get, recursively, all files under this folder
-        files = list(pathlib.Path(folder).rglob("*.*"))
-        # Move each file to the first level if its not already there
-        for file in files:
-            if file.parent != pathlib.Path(vault):
-                try:
-                    shutil.move(file, folder)
-                except Exception as e:
-                    pass
-
-        # List all directories under this folder
-        dirs = [d for d in os.listdir(folder) if os.path.isdir(os.path.join(folder, d))]
-        # Delete each directory
-        for dir in dirs:
-            shutil.rmtree(os.path.join(folder, dir))
+    # Walk through vault once, finding all .md files to convert to JSON.
+    # Removes everything else, including directories that start with . or _
+    # Only the highest level folders inside the 'vault' are kept, so all
+    # notes below this first level are written to their first level folder
+    notes = {}
+    nested_dirs = []
+    for note in find_notes(vault, vault, nested_dirs):
+        # If two notes end up with the same name in the same folder, the one
+        # closest to the first level folder is kept, and the first one found
+        # if they are as deep. The other note is deleted
+        json_file = note[2]
+        kept = notes.get(json_file)
+        if kept is not None and len(kept[1].parts) <= len(note[1].parts):
+            os.remove(note[0])
+            continue
+        if kept is not None:
+            os.remove(kept[0])
+        notes[json_file] = note
+
+    # Reading and converting the notes is all Python work,
+    # so spread it over every CPU with processes
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(convert_note, notes.values(), chunksize=64))
+
+    # The folders below the first level are empty now, since every note
+    # was deleted once converted. Deepest come first, so rmdir is enough
+    for folder in nested_dirs:
+        os.rmdir(folder)
 
 
 if __name__ == "__main__":